@@ -6,12 +6,24 @@ Facebook Auto-Post from Text/Word Files
 Đọc nội dung từ file .txt hoặc .docx và đăng lên Facebook
 """
 
+import hashlib
+import json
+import mimetypes
 import os
+import re
 import sys
-import glob
-import requests
-from datetime import datetime
+import threading
+import time
+import traceback
+import xml.etree.ElementTree as ET
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from urllib.parse import urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Try import docx (optional)
 try:
@@ -22,18 +34,244 @@ except ImportError:
     print("⚠️ python-docx not installed. .docx files will be skipped.")
     print("   Install: pip install python-docx")
 
+# Try import requests-toolbelt (optional, streams image uploads)
+try:
+    from requests_toolbelt import MultipartEncoder
+    STREAMING_UPLOAD = True
+except ImportError:
+    STREAMING_UPLOAD = False
+
+# Try import orjson (optional, faster JSON parsing)
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
 # ========== CẤU HÌNH ==========
 
 POSTS_DIR = "posts"          # Thư mục chứa file nội dung
 IMAGES_DIR = "images"        # Thư mục chứa ảnh
 CONFIG_FILE = "config.txt"   # File cấu hình Facebook pages
+CACHE_FILE = ".cache.json"   # Cache nội dung đã parse + photo_id đã upload
+
+# Tăng khi thay đổi cách đọc/parse bài (bỏ cache 'posts' cũ)
+POST_PARSER_VERSION = 4
+# photo_id đã upload (bài đăng lỗi) chỉ được dùng lại trong khoảng này (giây)
+PHOTO_CACHE_MAX_AGE = 24 * 3600
 
 # Facebook Graph API
 GRAPH_API_VERSION = "v18.0"
 GRAPH_API_BASE = f"https://graph.facebook.com/{GRAPH_API_VERSION}"
 
+# Số page đăng song song tối đa cho mỗi bài
+MAX_PARALLEL_PAGES = 16
+
+# Số ảnh upload song song tối đa cho mỗi page
+MAX_PARALLEL_UPLOADS = 8
+
+# Gộp upload ảnh + đăng bài thành 1 request (Graph API batch)
+USE_BATCH_API = False
+
+# Giới hạn số Graph API calls (~200 calls/giờ/app), tính mọi request:
+# test connection, upload ảnh, đăng bài, từng sub-request của batch
+RATE_LIMIT_CALLS = 200
+RATE_LIMIT_PERIOD = 3600     # giây
+
+# Graph API error codes / HTTP status tạm thời (thử lại với exponential backoff)
+TRANSIENT_ERROR_CODES = {1, 2, 4, 17, 32, 613}
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+MAX_API_RETRIES = 3
+
 # ========== HELPER FUNCTIONS ==========
 
+def create_http_session():
+    """
+    Tạo requests.Session dùng chung (keep-alive + connection pool)
+    để các request tới graph.facebook.com tái sử dụng kết nối TLS
+    """
+    session = requests.Session()
+    session.headers.update({'Connection': 'keep-alive'})
+    session.verify = True
+    
+    # POST (/feed, /photos) is not idempotent: a re-sent request after a
+    # read timeout or 5xx can publish twice. Only GET is retried here;
+    # POST errors (HTTP or Graph-level) are retried by FacebookPoster._graph_post.
+    # raise_on_status=False returns the last response so the Graph error
+    # JSON (code/message) is not lost in a RetryError.
+    retry = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=frozenset(['GET']),
+        raise_on_status=False
+    )
+    # Pages x uploads per page can all be in flight at once; a smaller
+    # pool discards connections ("Connection pool is full") and loses keep-alive
+    adapter = HTTPAdapter(pool_connections=8,
+                          pool_maxsize=MAX_PARALLEL_PAGES * MAX_PARALLEL_UPLOADS,
+                          max_retries=retry)
+    session.mount('https://', adapter)
+    
+    return session
+
+HTTP_SESSION = create_http_session()
+
+class RateLimiter:
+    """
+    Token bucket (thread-safe): tối đa max_calls trong period giây.
+    Chỉ chờ khi đã dùng hết quota, không sleep cố định.
+    """
+    def __init__(self, max_calls, period):
+        self.capacity = max_calls
+        self.tokens = float(max_calls)
+        self.rate = max_calls / period
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self, count=1):
+        """Chờ đến khi đủ count token (1 token = 1 Graph API call)"""
+        count = min(count, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                
+                if self.tokens >= count:
+                    self.tokens -= count
+                    return
+                
+                wait = (count - self.tokens) / self.rate
+            time.sleep(wait)
+
+RATE_LIMITER = RateLimiter(RATE_LIMIT_CALLS, RATE_LIMIT_PERIOD)
+
+_LOG_LOCK = threading.Lock()
+
+def log(message):
+    """print() an toàn giữa các thread: mỗi message in trọn vẹn, không bị xen"""
+    with _LOG_LOCK:
+        sys.stdout.write(message + '\n')
+        sys.stdout.flush()
+
+def file_hash(filepath):
+    """SHA-256 của nội dung file (đọc theo block 1 MB)"""
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def _valid_post_entry(entry):
+    """{'text': str, 'images': [str, ...]}"""
+    return (isinstance(entry, dict)
+            and isinstance(entry.get('text'), str)
+            and isinstance(entry.get('images'), list)
+            and all(isinstance(name, str) for name in entry['images']))
+
+def _valid_photo_entry(entry):
+    """{'id': str, 'time': số}"""
+    return (isinstance(entry, dict)
+            and isinstance(entry.get('id'), str)
+            and isinstance(entry.get('time'), (int, float))
+            and not isinstance(entry.get('time'), bool))
+
+class ContentCache:
+    """
+    Cache lưu trong CACHE_FILE, key theo SHA-256 nội dung file:
+        posts:  hash -> {'text', 'images'} đã parse (theo POST_PARSER_VERSION)
+        photos: hash:page_id -> {'id', 'time'} photo_id đã upload nhưng
+                chưa gắn vào bài nào (bài đăng lỗi), dùng lại ở lần sau
+    """
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.data = {'version': POST_PARSER_VERSION, 'posts': {}, 'photos': {}}
+        self.lock = threading.Lock()
+        self.dirty = False
+    
+    def load(self):
+        if not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            
+            if not isinstance(data, dict):
+                raise ValueError("not a JSON object")
+            posts = data.get('posts', {})
+            photos = data.get('photos', {})
+            if not isinstance(posts, dict) or not isinstance(photos, dict):
+                raise ValueError("'posts'/'photos' must be objects")
+            
+            # Parsed posts from another parser version are stale
+            valid_posts = {}
+            if data.get('version') == POST_PARSER_VERSION:
+                valid_posts = {key: entry for key, entry in posts.items() if _valid_post_entry(entry)}
+            
+            # Drop expired (or malformed) photo ids
+            now = time.time()
+            valid_photos = {
+                key: entry for key, entry in photos.items()
+                if _valid_photo_entry(entry) and 0 <= now - entry['time'] < PHOTO_CACHE_MAX_AGE
+            }
+        except Exception as e:
+            print(f"⚠️ Ignoring invalid cache {self.cache_file}: {e}")
+            self.dirty = True
+            return
+        
+        self.data['posts'].update(valid_posts)
+        self.data['photos'].update(valid_photos)
+        
+        if len(valid_posts) != len(posts) or len(valid_photos) != len(photos):
+            self.dirty = True
+    
+    def get(self, section, key):
+        with self.lock:
+            return self.data[section].get(key)
+    
+    def set(self, section, key, value):
+        with self.lock:
+            self.data[section][key] = value
+            self.dirty = True
+    
+    def delete(self, section, key):
+        with self.lock:
+            if self.data[section].pop(key, None) is not None:
+                self.dirty = True
+    
+    def prune(self, section, keep):
+        """Chỉ giữ lại các key trong keep"""
+        with self.lock:
+            entries = self.data[section]
+            stale = [key for key in entries if key not in keep]
+            for key in stale:
+                del entries[key]
+            if stale:
+                self.dirty = True
+    
+    def get_photo(self, key):
+        entry = self.get('photos', key)
+        return entry['id'] if entry else None
+    
+    def set_photo(self, key, photo_id):
+        self.set('photos', key, {'id': photo_id, 'time': time.time()})
+    
+    def save(self):
+        """Ghi cache (atomic rename để không hỏng file khi crash)"""
+        with self.lock:
+            if not self.dirty:
+                return
+            tmp_file = f"{self.cache_file}.tmp"
+            try:
+                with open(tmp_file, 'w', encoding='utf-8') as f:
+                    json.dump(self.data, f, ensure_ascii=False)
+                os.replace(tmp_file, self.cache_file)
+                self.dirty = False
+            except Exception as e:
+                print(f"⚠️ Could not save cache {self.cache_file}: {e}")
+
+CACHE = ContentCache(CACHE_FILE)
+
 def load_facebook_pages(config_file):
     """
     Đọc danh sách Facebook pages từ config.txt
@@ -45,62 +283,157 @@ def load_facebook_pages(config_file):
         print(f"❌ Config file not found: {config_file}")
         return pages
     
-    with open(config_file, 'r', encoding='utf-8') as f:
-        for line_num, line in enumerate(f, 1):
-            line = line.strip()
-            
-            # Skip comments and empty lines
-            if not line or line.startswith('#'):
-                continue
-            
-            parts = line.split('|')
-            if len(parts) < 2:
-                print(f"⚠️ Invalid format at line {line_num}: {line}")
+    data = Path(config_file).read_text(encoding='utf-8')
+    
+    for line_num, raw_line in enumerate(data.splitlines(), 1):
+        line = raw_line.strip()
+        
+        # Skip comments and empty lines
+        if not line or line[0] == '#':
+            continue
+        
+        page_id, sep, rest = line.partition('|')
+        if not sep:
+            print(f"⚠️ Invalid format at line {line_num}: {line}")
+            continue
+        
+        token, _, name = rest.partition('|')
+        page_id = page_id.strip()
+        token = token.strip()
+        name = name.partition('|')[0].strip() or f"Page_{page_id}"
+        
+        # Get token from env if placeholder
+        if token.startswith('$'):
+            env_var = token[1:]
+            token = os.environ.get(env_var, '')
+            if not token:
+                print(f"⚠️ Environment variable {env_var} not set")
                 continue
-            
-            page_id = parts[0].strip()
-            token = parts[1].strip()
-            name = parts[2].strip() if len(parts) > 2 else f"Page_{page_id}"
-            
-            # Get token from env if placeholder
-            if token.startswith('$'):
-                env_var = token[1:]
-                token = os.environ.get(env_var, '')
-                if not token:
-                    print(f"⚠️ Environment variable {env_var} not set")
-                    continue
-            
-            pages.append({
-                'page_id': page_id,
-                'token': token,
-                'name': name
-            })
-            print(f"  ✅ Loaded: {name}")
+        
+        pages.append({
+            'page_id': page_id,
+            'token': token,
+            'name': name
+        })
+        print(f"  ✅ Loaded: {name}")
     
     return pages
 
 def read_text_file(filepath):
     """Đọc file .txt"""
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            return f.read()
+        # One unbuffered read; normalize newlines like text mode did
+        content = Path(filepath).read_bytes().decode('utf-8')
+        if '\r' in content:
+            content = content.replace('\r\n', '\n').replace('\r', '\n')
+        return content
     except Exception as e:
         print(f"❌ Error reading {filepath}: {e}")
         return None
 
+def prepare_image(image_path):
+    """
+    Chuẩn bị thông tin ảnh 1 lần cho tất cả các page (nội dung ảnh
+    không giữ trong bộ nhớ, mỗi lần upload sẽ stream từ file)
+    Returns: {'name', 'path', 'mime', 'sha256'} hoặc None nếu lỗi
+    """
+    try:
+        digest = file_hash(image_path)
+    except FileNotFoundError:
+        print(f"  ❌ Image not found: {image_path}")
+        return None
+    except Exception as e:
+        print(f"  ❌ Error reading {image_path}: {e}")
+        return None
+    
+    return {
+        'name': os.path.basename(image_path),
+        'path': image_path,
+        'mime': mimetypes.guess_type(image_path)[0] or 'application/octet-stream',
+        'sha256': digest
+    }
+
+# WordprocessingML namespace (word/document.xml)
+_W = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+
+def _docx_run_text(run):
+    """Text của 1 <w:r>, giống python-docx 1.1.0 CT_R.text"""
+    parts = []
+    for item in run:
+        tag = item.tag
+        if tag == f'{_W}t':
+            parts.append(item.text or '')
+        elif tag in (f'{_W}tab', f'{_W}ptab'):
+            parts.append('\t')
+        elif tag == f'{_W}br':
+            # Page/column breaks have no text
+            if item.get(f'{_W}type', 'textWrapping') == 'textWrapping':
+                parts.append('\n')
+        elif tag == f'{_W}cr':
+            parts.append('\n')
+        elif tag == f'{_W}noBreakHyphen':
+            parts.append('-')
+    return ''.join(parts)
+
+def _docx_paragraph_text(paragraph):
+    """Text của 1 <w:p>, giống python-docx Paragraph.text (w:r | w:hyperlink)"""
+    parts = []
+    for child in paragraph:
+        if child.tag == f'{_W}r':
+            parts.append(_docx_run_text(child))
+        elif child.tag == f'{_W}hyperlink':
+            parts.extend(_docx_run_text(run) for run in child.iterfind(f'{_W}r'))
+    return ''.join(parts)
+
+def read_docx_xml(filepath):
+    """
+    Đọc text trực tiếp từ word/document.xml (không load toàn bộ
+    object model của python-docx). Chỉ lấy <w:p> con trực tiếp của
+    <w:body> như doc.paragraphs; mỗi phần tử của body được clear ngay
+    """
+    paragraphs = []
+    stack = []
+    
+    with zipfile.ZipFile(filepath) as z, z.open('word/document.xml') as f:
+        for event, el in ET.iterparse(f, events=('start', 'end')):
+            if event == 'start':
+                stack.append(el.tag)
+                continue
+            
+            stack.pop()
+            if stack and stack[-1] == f'{_W}body':
+                if el.tag == f'{_W}p':
+                    text = _docx_paragraph_text(el)
+                    if text.strip():
+                        paragraphs.append(text)
+                el.clear()
+    
+    return '\n'.join(paragraphs)
+
 def read_docx_file(filepath):
     """Đọc file .docx"""
     if not DOCX_SUPPORT:
         return None
     
+    # Fast path: direct XML scan, fall back to python-docx
+    try:
+        return read_docx_xml(filepath)
+    except Exception:
+        pass
+    
     try:
         doc = Document(filepath)
-        content = '\n'.join([p.text for p in doc.paragraphs if p.text.strip()])
-        return content
+        texts = (p.text for p in doc.paragraphs)
+        return '\n'.join(t for t in texts if t and not t.isspace())
     except Exception as e:
         print(f"❌ Error reading {filepath}: {e}")
         return None
 
+# Dòng chỉ định ảnh: "IMAGE: filename.jpg" (không phân biệt hoa/thường).
+# [^\S\n] = mọi khoảng trắng Unicode trừ xuống dòng (NBSP, \u3000, \f...),
+# giống line.strip(); chữ cái liệt kê tay để khớp đúng line.upper()
+_IMAGE_RE = re.compile(r'(?m)^[^\S\n]*[Iiı][Mm][Aa][Gg][Ee]:[^\S\n]*(.*?)[^\S\n]*$\n?')
+
 def parse_post_content(content):
     """
     Parse nội dung bài đăng
@@ -115,21 +448,8 @@ def parse_post_content(content):
         'images': ['file1.jpg', 'file2.png']
     }
     """
-    lines = content.split('\n')
-    images = []
-    text_lines = []
-    
-    for line in lines:
-        line_stripped = line.strip()
-        
-        # Check if line specifies image
-        if line_stripped.upper().startswith('IMAGE:'):
-            img_filename = line_stripped[6:].strip()
-            images.append(img_filename)
-        else:
-            text_lines.append(line)
-    
-    text = '\n'.join(text_lines).strip()
+    images = _IMAGE_RE.findall(content)
+    text = _IMAGE_RE.sub('', content).strip()
     
     return {
         'text': text,
@@ -138,16 +458,17 @@ def parse_post_content(content):
 
 def get_all_post_files(posts_dir):
     """Lấy tất cả file .txt và .docx trong thư mục posts/"""
-    files = []
-    
-    # Get .txt files
-    txt_files = glob.glob(os.path.join(posts_dir, "*.txt"))
-    files.extend(txt_files)
-    
-    # Get .docx files if supported
-    if DOCX_SUPPORT:
-        docx_files = glob.glob(os.path.join(posts_dir, "*.docx"))
-        files.extend(docx_files)
+    # .docx only if supported
+    exts = ('.txt', '.docx') if DOCX_SUPPORT else ('.txt',)
+    
+    # Single directory pass (hidden files skipped, like glob)
+    with os.scandir(posts_dir) as entries:
+        files = [
+            entry.path for entry in entries
+            if not entry.name.startswith('.')
+            and entry.name.lower().endswith(exts)
+            and entry.is_file()
+        ]
     
     # Sort by filename
     files.sort()
@@ -164,24 +485,38 @@ def load_post_from_file(filepath):
     
     print(f"\n📄 Reading: {filename}")
     
-    # Read content based on extension
-    if ext == '.txt':
-        content = read_text_file(filepath)
-    elif ext == '.docx':
-        content = read_docx_file(filepath)
-    else:
+    if ext not in ('.txt', '.docx'):
         print(f"  ⚠️ Unsupported file type: {ext}")
         return None
     
-    if not content:
+    # Unchanged file: reuse parsed content from cache
+    try:
+        content_hash = file_hash(filepath)
+    except Exception as e:
+        print(f"❌ Error reading {filepath}: {e}")
         return None
     
-    # Parse content
-    parsed = parse_post_content(content)
-    
-    if not parsed['text']:
-        print(f"  ⚠️ No text content found")
-        return None
+    parsed = CACHE.get('posts', content_hash)
+    if parsed:
+        print(f"  ♻️ Unchanged, using cache")
+    else:
+        # Read content based on extension
+        if ext == '.txt':
+            content = read_text_file(filepath)
+        else:
+            content = read_docx_file(filepath)
+        
+        if not content:
+            return None
+        
+        # Parse content
+        parsed = parse_post_content(content)
+        
+        if not parsed['text']:
+            print(f"  ⚠️ No text content found")
+            return None
+        
+        CACHE.set('posts', content_hash, parsed)
     
     print(f"  ✅ Text: {len(parsed['text'])} characters")
     if parsed['images']:
@@ -191,6 +526,7 @@ def load_post_from_file(filepath):
     
     return {
         'filename': filename,
+        'hash': content_hash,
         'text': parsed['text'],
         'images': parsed['images']
     }
@@ -202,127 +538,318 @@ class FacebookPoster:
         self.page_id = page_id
         self.token = access_token
         self.name = page_name
+        self.http = HTTP_SESSION
+        
+        # Built once per page instead of on every request
+        base = f"{GRAPH_API_BASE}/{page_id}"
+        self.url_node, self.url_photos, self.url_feed = base, f"{base}/photos", f"{base}/feed"
+        self.auth_params = {'access_token': access_token}
+        self.node_params = {'fields': 'name,fan_count', **self.auth_params}
+    
+    def _log(self, message):
+        """In log kèm tên page (các page chạy song song)"""
+        log('\n'.join(f"  [{self.name}] {line}" for line in message.split('\n')))
     
     def test_connection(self):
         """Test connection to Facebook Page"""
-        url = f"{GRAPH_API_BASE}/{self.page_id}"
-        params = {
-            'fields': 'name,fan_count',
-            'access_token': self.token
-        }
-        
         try:
-            response = requests.get(url, params=params, timeout=10)
+            RATE_LIMITER.acquire()
+            response = self.http.get(self.url_node, params=self.node_params, timeout=10)
             if response.status_code == 200:
-                data = response.json()
+                data = json_loads(response.content)
                 actual_name = data.get('name', 'Unknown')
                 fans = data.get('fan_count', 0)
-                print(f"✅ Connected: {actual_name} ({fans:,} followers)")
+                self._log(f"✅ Connected: {actual_name} ({fans:,} followers)")
                 return True
             else:
-                error = response.json().get('error', {})
-                print(f"❌ Connection failed: {error.get('message', 'Unknown error')}")
+                error = json_loads(response.content).get('error', {})
+                self._log(f"❌ Connection failed: {error.get('message', 'Unknown error')}")
                 return False
         except Exception as e:
-            print(f"❌ Connection error: {e}")
+            self._log(f"❌ Connection error: {e}")
             return False
     
+    def test_connection_return_self(self):
+        """Test connection, trả về self nếu OK (hoặc None)"""
+        return self if self.test_connection() else None
+    
     def upload_photo(self, image_path):
         """Upload ảnh lên Facebook, trả về photo_id"""
-        url = f"{GRAPH_API_BASE}/{self.page_id}/photos"
-        
-        if not os.path.exists(image_path):
-            print(f"  ❌ Image not found: {image_path}")
+        image = prepare_image(image_path)
+        if not image:
             return None
+        return self.upload_image(image)
+    
+    def upload_image(self, image, use_cache=True):
+        """
+        Upload 1 ảnh (từ prepare_image), trả về photo_id
+        use_cache=False: luôn upload mới, không đọc/ghi cache
+        """
+        name = image['name']
+        
+        # Same image already uploaded to this page
+        cache_key = self._photo_key(image)
+        photo_id = CACHE.get_photo(cache_key) if use_cache else None
+        if photo_id:
+            self._log(f"♻️ Cached: {name} → {photo_id}")
+            return photo_id
+        
+        def make_request(handles):
+            # Fresh file handle (and encoder) per attempt: a retry must not
+            # re-send an already consumed stream
+            img_file = open(image['path'], 'rb')
+            handles.append(img_file)
+            source = (name, img_file, image['mime'])
+            
+            if STREAMING_UPLOAD:
+                # Stream file to socket in chunks instead of buffering it
+                encoder = MultipartEncoder(fields={
+                    **self.auth_params,
+                    'published': 'false',
+                    'source': source
+                })
+                return {'data': encoder, 'headers': {'Content-Type': encoder.content_type}}
+            
+            form = {
+                **self.auth_params,
+                'published': 'false'
+            }
+            return {'files': {'source': source}, 'data': form}
         
         try:
-            with open(image_path, 'rb') as img_file:
-                files = {'source': img_file}
-                data = {
-                    'access_token': self.token,
-                    'published': 'false'
-                }
-                
-                response = requests.post(url, files=files, data=data, timeout=60)
-                result = response.json()
-                
-                if 'id' in result:
-                    print(f"  ✅ Uploaded: {os.path.basename(image_path)} → {result['id']}")
-                    return result['id']
-                else:
-                    error = result.get('error', {}).get('message', 'Unknown')
-                    print(f"  ❌ Upload failed: {error}")
-                    return None
+            # Safe to retry: published=false at worst leaves an orphan photo
+            result = self._graph_post(self.url_photos, make_request, timeout=120)
+            
+            if 'id' in result:
+                self._log(f"✅ Uploaded: {name} → {result['id']}")
+                if use_cache:
+                    CACHE.set_photo(cache_key, result['id'])
+                return result['id']
+            else:
+                error = result.get('error', {}).get('message', 'Unknown')
+                self._log(f"❌ Upload failed: {error}")
+                return None
+        except FileNotFoundError:
+            self._log(f"❌ Image not found: {image['path']}")
+            return None
         except Exception as e:
-            print(f"  ❌ Upload error: {e}")
+            self._log(f"❌ Upload error: {e}")
             return None
     
+    def _photo_key(self, image):
+        return f"{image['sha256']}:{self.page_id}"
+    
+    def upload_images(self, images):
+        """
+        Upload nhiều ảnh song song
+        Returns: (list photo_id giữ thứ tự, list cache key đã lấy từ cache)
+        """
+        # Identical images in one post (listed twice, or a copy under another
+        # name) each need their own photo id: only the first may use the cache
+        seen = set()
+        use_cache = []
+        for image in images:
+            key = self._photo_key(image)
+            use_cache.append(key not in seen)
+            seen.add(key)
+        
+        reused = [
+            self._photo_key(image) for image, cached in zip(images, use_cache)
+            if cached and CACHE.get_photo(self._photo_key(image))
+        ]
+        
+        workers = min(MAX_PARALLEL_UPLOADS, len(images))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(self.upload_image, images, use_cache)
+            photo_ids = [pid for pid in results if pid]
+        
+        return photo_ids, reused
+    
     def post_text_only(self, message):
         """Đăng bài chỉ có text"""
-        url = f"{GRAPH_API_BASE}/{self.page_id}/feed"
         data = {
             'message': message,
-            'access_token': self.token
+            **self.auth_params
         }
         
-        try:
-            response = requests.post(url, data=data, timeout=30)
-            return response.json()
-        except Exception as e:
-            return {'error': {'message': str(e)}}
+        return self._post_feed(data)
     
     def post_with_photos(self, message, photo_ids):
         """Đăng bài có 1 hoặc nhiều ảnh"""
-        url = f"{GRAPH_API_BASE}/{self.page_id}/feed"
-        
         # Prepare attached media
-        if len(photo_ids) == 1:
-            attached_media = [{'media_fbid': photo_ids[0]}]
-        else:
-            attached_media = [{'media_fbid': pid} for pid in photo_ids]
+        attached_media = [{'media_fbid': pid} for pid in photo_ids]
         
         data = {
             'message': message,
-            'attached_media': str(attached_media).replace("'", '"'),
-            'access_token': self.token
+            'attached_media': json.dumps(attached_media, separators=(',', ':')),
+            **self.auth_params
         }
         
+        return self._post_feed(data)
+    
+    def _post_feed(self, data):
+        """POST lên /feed, thử lại khi Graph API trả lỗi tạm thời"""
         try:
-            response = requests.post(url, data=data, timeout=30)
-            return response.json()
+            return self._graph_post(self.url_feed, lambda handles: {'data': data}, timeout=30)
         except Exception as e:
             return {'error': {'message': str(e)}}
     
-    def post(self, message, image_paths=None):
+    def _graph_post(self, url, make_request, timeout):
+        """
+        POST lên Graph API, thử lại với exponential backoff khi lỗi tạm thời
+        (HTTP status trong RETRY_STATUS_CODES hoặc error.code trong
+        TRANSIENT_ERROR_CODES). Lỗi mạng (timeout...) không thử lại: request
+        có thể đã tới server.
+        Args:
+            make_request: hàm(handles) -> kwargs cho requests.post, gọi lại
+                mỗi lần thử; file mở thêm vào handles sẽ được đóng
+        Returns: JSON kết quả (dict)
+        """
+        for attempt in range(MAX_API_RETRIES + 1):
+            handles = []
+            try:
+                request_kwargs = make_request(handles)
+                RATE_LIMITER.acquire()
+                response = self.http.post(url, timeout=timeout, **request_kwargs)
+            except requests.RequestException as e:
+                return {'error': {'message': str(e)}}
+            finally:
+                for handle in handles:
+                    handle.close()
+            
+            # Gateway errors (502/503) often come back as HTML, not JSON
+            try:
+                result = json_loads(response.content)
+            except ValueError:
+                result = None
+            if not isinstance(result, dict):
+                result = {'error': {'message': f"HTTP {response.status_code}: {response.text[:200]}"}}
+            
+            error = result.get('error') or {}
+            transient = (response.status_code in RETRY_STATUS_CODES
+                         or error.get('code') in TRANSIENT_ERROR_CODES)
+            if not transient or attempt == MAX_API_RETRIES:
+                return result
+            
+            wait = 2 ** attempt
+            reason = error.get('code') or f"HTTP {response.status_code}"
+            self._log(f"⏳ Temporary error ({reason}), retrying in {wait}s...")
+            time.sleep(wait)
+    
+    def post_batched(self, message, images):
+        """
+        Upload ảnh và đăng bài trong 1 request duy nhất (Graph API batch)
+        Args:
+            images: List ảnh từ prepare_image
+        Returns: kết quả của request /feed (giống post_with_photos)
+        """
+        batch = []
+        files = {}
+        handles = []
+        
+        try:
+            for i, image in enumerate(images):
+                img_file = open(image['path'], 'rb')
+                handles.append(img_file)
+                files[f'img{i}'] = (image['name'], img_file, image['mime'])
+                batch.append({
+                    'method': 'POST',
+                    'relative_url': f"{self.page_id}/photos",
+                    'body': 'published=false',
+                    'attached_files': f'img{i}',
+                    'name': f'photo{i}'
+                })
+            
+            # Feed request references the uploaded photo ids
+            body = urlencode({'message': message})
+            for i in range(len(images)):
+                media = json.dumps({'media_fbid': f'{{result=photo{i}:$.id}}'})
+                body += f'&attached_media[{i}]={media}'
+            batch.append({
+                'method': 'POST',
+                'relative_url': f"{self.page_id}/feed",
+                'body': body
+            })
+            
+            data = {
+                **self.auth_params,
+                'batch': json.dumps(batch)
+            }
+            # Each sub-request counts against the rate limit
+            RATE_LIMITER.acquire(len(batch))
+            response = self.http.post(GRAPH_API_BASE, files=files, data=data, timeout=120)
+            results = json_loads(response.content)
+        except Exception as e:
+            return {'error': {'message': str(e)}}
+        finally:
+            for img_file in handles:
+                img_file.close()
+        
+        # Top-level error (e.g. invalid token)
+        if not isinstance(results, list):
+            return results
+        
+        # Successful photo uploads are omitted (null); report failed ones
+        for image, sub in zip(images, results[:-1]):
+            if sub and sub.get('code') != 200:
+                self._log(f"❌ Upload failed: {image['name']}")
+        
+        feed = results[-1] if results else None
+        if not feed:
+            return {'error': {'message': 'Empty batch response'}}
+        
+        try:
+            return json_loads(feed.get('body') or '{}')
+        except ValueError:
+            return {'error': {'message': feed.get('body', 'Invalid batch response')}}
+    
+    def post(self, message, images=None):
         """
         Đăng bài lên Facebook
         Args:
             message: Nội dung bài viết
-            image_paths: List các đường dẫn ảnh (hoặc None)
+            images: List ảnh từ prepare_image (hoặc None)
         """
-        print(f"\n  📤 Posting to: {self.name}")
+        self._log("📤 Posting...")
+        
+        # Upload images + post to feed in one batch request
+        if USE_BATCH_API and images:
+            result = self.post_batched(message, images)
+            return self._handle_result(result)
         
-        # Upload images first
-        photo_ids = []
-        if image_paths:
-            for img_path in image_paths:
-                photo_id = self.upload_photo(img_path)
-                if photo_id:
-                    photo_ids.append(photo_id)
+        # Upload images first (concurrently, keeping the author's order)
+        photo_ids, reused = self.upload_images(images) if images else ([], [])
         
         # Post to feed
         if photo_ids:
             result = self.post_with_photos(message, photo_ids)
+            
+            # Cached photo ids may be stale (already attached / deleted):
+            # evict them and retry once with fresh uploads
+            if 'id' not in result and reused:
+                self._log(f"♻️ Post failed with cached photos, re-uploading...")
+                for key in reused:
+                    CACHE.delete('photos', key)
+                photo_ids, _ = self.upload_images(images)
+                if photo_ids:
+                    result = self.post_with_photos(message, photo_ids)
+            
+            # Attached photo ids can't be attached again by later posts;
+            # only ids from failed feed posts stay cached for the next try
+            if 'id' in result:
+                for key in {self._photo_key(image) for image in images}:
+                    CACHE.delete('photos', key)
         else:
             result = self.post_text_only(message)
         
-        # Check result
+        return self._handle_result(result)
+    
+    def _handle_result(self, result):
+        """Kiểm tra kết quả đăng bài"""
         if 'id' in result:
             post_id = result['id']
             post_url = f"https://facebook.com/{post_id}"
-            print(f"  ✅ Posted successfully!")
-            print(f"     ID: {post_id}")
-            print(f"     URL: {post_url}")
+            self._log(f"✅ Posted successfully!\n   ID: {post_id}\n   URL: {post_url}")
             return {
                 'success': True,
                 'post_id': post_id,
@@ -330,7 +857,7 @@ class FacebookPoster:
             }
         else:
             error = result.get('error', {}).get('message', 'Unknown error')
-            print(f"  ❌ Post failed: {error}")
+            self._log(f"❌ Post failed: {error}")
             return {
                 'success': False,
                 'error': error
@@ -366,11 +893,11 @@ def main():
     
     # Test connections
     print("\n🔌 Testing connections...")
-    valid_pages = []
-    for page in pages:
-        poster = FacebookPoster(page['page_id'], page['token'], page['name'])
-        if poster.test_connection():
-            valid_pages.append(poster)
+    posters = [FacebookPoster(page['page_id'], page['token'], page['name']) for page in pages]
+    workers = min(MAX_PARALLEL_PAGES, len(posters))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # map() keeps config.txt order
+        valid_pages = [p for p in executor.map(FacebookPoster.test_connection_return_self, posters) if p]
     
     if not valid_pages:
         print("❌ No valid Facebook pages found!")
@@ -390,11 +917,15 @@ def main():
     print(f"✅ Found {len(post_files)} post file(s)")
     
     # Load posts
+    CACHE.load()
     posts = []
     for filepath in post_files:
         post_data = load_post_from_file(filepath)
         if post_data:
             posts.append(post_data)
+    # Forget files that were removed or edited
+    CACHE.prune('posts', {post['hash'] for post in posts})
+    CACHE.save()
     
     if not posts:
         print("❌ No valid posts loaded!")
@@ -410,6 +941,10 @@ def main():
     total_success = 0
     total_failed = 0
     
+    # Resolve images with one directory scan instead of a stat() per image
+    with os.scandir(IMAGES_DIR) as entries:
+        images_index = {entry.name: entry.path for entry in entries if entry.is_file()}
+    
     for i, post in enumerate(posts, 1):
         print(f"\n[{i}/{len(posts)}] Processing: {post['filename']}")
         print("-" * 80)
@@ -417,24 +952,40 @@ def main():
         # Prepare image paths
         image_paths = []
         for img_filename in post['images']:
-            img_path = os.path.join(IMAGES_DIR, img_filename)
-            if os.path.exists(img_path):
+            img_path = images_index.get(img_filename)
+            if img_path is None:
+                # Not an exact name match: sub-folder path, or a name that only
+                # matches on case-insensitive/normalizing filesystems
+                # (Photo.JPG vs photo.jpg, NFC vs NFD Vietnamese names)
+                candidate = os.path.join(IMAGES_DIR, img_filename)
+                if os.path.isfile(candidate):
+                    img_path = candidate
+            
+            if img_path:
                 image_paths.append(img_path)
             else:
                 print(f"  ⚠️ Image not found: {img_filename}")
         
-        # Post to all pages
-        for poster in valid_pages:
-            result = poster.post(post['text'], image_paths if image_paths else None)
-            
+        # Hash/mime once per post, shared by all pages
+        images = [image for image in map(prepare_image, image_paths) if image]
+        
+        # Post to all pages in parallel (each page is independent).
+        # Every Graph call waits on RATE_LIMITER only once the budget is used up
+        workers = min(MAX_PARALLEL_PAGES, len(valid_pages))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(
+                lambda poster: poster.post(post['text'], images if images else None),
+                valid_pages
+            ))
+        
+        for result in results:
             if result['success']:
                 total_success += 1
             else:
                 total_failed += 1
-            
-            # Small delay between posts
-            import time
-            time.sleep(2)
+        
+        # Persist uploaded photo ids after each post
+        CACHE.save()
     
     # Summary
     print("\n" + "=" * 80)
@@ -457,6 +1008,5 @@ if __name__ == "__main__":
         sys.exit(0)
     except Exception as e:
         print(f"\n❌ FATAL ERROR: {e}")
-        import traceback
         traceback.print_exc()
         sys.exit(1)